@@ -3,14 +3,18 @@ import psycopg2
 import os
 from dotenv import load_dotenv
 from streamlit_option_menu import option_menu
-import bcrypt
 from openai import OpenAI
 import streamlit.components.v1 as components
 from google.cloud import storage
 import sqlalchemy
-import pg8000
 import uuid
 
+import metrics
+import passwords
+import chat_partitions
+import image_jobs
+from db import get_db_connection
+
 # Import the functions from other files
 from image_generation import image_generation_page
 
@@ -32,23 +36,9 @@ storage_client = storage.Client()
 bucket_name = "streamlit-blog"  # Your actual bucket name
 bucket = storage_client.bucket(bucket_name)
 
-# Database connection
-def get_db_connection():
-    db_config = {
-        "database": os.getenv("DB_NAME"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASS"),
-        "host": "127.0.0.1",  # Use localhost when using Cloud SQL proxy
-        "port": 5432
-    }
-    
-    engine = sqlalchemy.create_engine(
-        "postgresql+pg8000://",
-        creator=lambda: pg8000.connect(**db_config)
-    )
-    return engine.connect()
-
-# Create tables if they don't exist
+# Create tables if they don't exist (once per process, not on every rerun)
+@st.cache_resource
+@metrics.timed("db")
 def create_tables():
     conn = get_db_connection()
     conn.execute(sqlalchemy.text("""
@@ -87,20 +77,16 @@ def create_tables():
     )
     """))
     
-    conn.execute(sqlalchemy.text("""
-    CREATE TABLE IF NOT EXISTS chat_messages (
-        id SERIAL PRIMARY KEY,
-        conversation_id INTEGER REFERENCES conversations(id),
-        role VARCHAR(10) NOT NULL,
-        content TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """))
+    # Monthly partitions on Postgres, plus the index of archived months
+    chat_partitions.create_table(conn)
+
+    image_jobs.create_table(conn)
     
     conn.commit()
     conn.close()
 
 # Function to upload file to Google Cloud Storage
+@metrics.timed("gcs")
 def upload_to_gcs(file):
     if file is not None:
         file_extension = os.path.splitext(file.name)[1]
@@ -113,25 +99,52 @@ def upload_to_gcs(file):
 # Modify create_new_post function to handle file uploads
 def create_new_post(title, content, author_id, uploaded_file=None):
     image_url = upload_to_gcs(uploaded_file) if uploaded_file else None
-    conn = get_db_connection()
-    conn.execute(sqlalchemy.text(
-        "INSERT INTO posts (title, content, author_id, image_url) VALUES (:title, :content, :author_id, :image_url)"
-    ), {"title": title, "content": content, "author_id": author_id, "image_url": image_url})
-    conn.commit()
-    conn.close()
-
-# User authentication
+    with metrics.span("db", "create_new_post"):
+        conn = get_db_connection()
+        conn.execute(sqlalchemy.text(
+            "INSERT INTO posts (title, content, author_id, image_url) VALUES (:title, :content, :author_id, :image_url)"
+        ), {"title": title, "content": content, "author_id": author_id, "image_url": image_url})
+        conn.commit()
+        conn.close()
+
+# User authentication (raises passwords.TooManyAttempts / PasswordServiceBusy)
 def authenticate_user(username, password):
-    conn = get_db_connection()
-    result = conn.execute(sqlalchemy.text(
-        "SELECT id, password FROM users WHERE username = :username"
-    ), {"username": username}).fetchone()
-    conn.close()
-    if result and bcrypt.checkpw(password.encode('utf-8'), result[1].encode('utf-8')):
-        return result[0]  # Return user id
-    return None
+    passwords.start_attempt(username)
+    user_id = None
+    try:
+        with metrics.span("db", "authenticate_user"):
+            conn = get_db_connection()
+            result = conn.execute(sqlalchemy.text(
+                "SELECT id, password FROM users WHERE username = :username"
+            ), {"username": username}).fetchone()
+            conn.close()
+        # bcrypt runs on the password pool, not in this script thread
+        if result and passwords.verify_password(password, result[1]):
+            user_id = result[0]
+            # Upgrade hashes stored at an older, cheaper cost
+            if passwords.needs_rehash(result[1]):
+                # Best effort: the password is already verified, so a failed rehash mustn't fail the login
+                try:
+                    rehash_password(user_id, password)
+                except Exception as e:
+                    print(f"Could not rehash password for user {user_id}: {e}")  # Debug print
+    finally:
+        passwords.finish_attempt(username, user_id is not None)
+    return user_id
+
+def rehash_password(user_id, password):
+    # Hash before opening the span, so bcrypt time isn't counted as database latency
+    hashed_password = passwords.hash_password(password)
+    with metrics.span("db", "rehash_password"):
+        conn = get_db_connection()
+        conn.execute(sqlalchemy.text(
+            "UPDATE users SET password = :password WHERE id = :user_id"
+        ), {"password": hashed_password, "user_id": user_id})
+        conn.commit()
+        conn.close()
 
 # Display recent posts
+@metrics.timed("db")
 def get_recent_posts():
     conn = get_db_connection()
     posts = conn.execute(sqlalchemy.text("""
@@ -149,10 +162,12 @@ def get_chatbot_response(messages, model="gpt-4o-mini"):
     try:
         print(f"Sending request to OpenAI with model: {model}")  # Debug print
         print(f"Messages: {messages}")  # Debug print
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        with metrics.span("llm", "get_chatbot_response"):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages
+            )
+        metrics.record_tokens(model, getattr(response, "usage", None))
         return response.choices[0].message.content
     except Exception as e:
         error_message = f"Error in get_chatbot_response: {str(e)}"
@@ -181,6 +196,8 @@ def chatbot_interface(key_suffix=""):
     conversation_titles.insert(0, "New Conversation")
 
     def on_conversation_change():
+        # The selectbox writes its own key; keep selected_conversation in step with it
+        st.session_state.selected_conversation = st.session_state.conversation_select
         st.session_state.messages = []
         if st.session_state.selected_conversation != "New Conversation":
             conversation_id = next(conv[0] for conv in st.session_state.conversations if conv[1] == st.session_state.selected_conversation)
@@ -256,6 +273,7 @@ def chatbot_interface(key_suffix=""):
         height=0
     )
 
+@metrics.timed("db")
 def create_conversation(user_id, title):
     conn = get_db_connection()
     result = conn.execute(sqlalchemy.text(
@@ -266,6 +284,7 @@ def create_conversation(user_id, title):
     conn.close()
     return conversation_id
 
+@metrics.timed("db")
 def get_user_conversations(user_id):
     conn = get_db_connection()
     conversations = conn.execute(sqlalchemy.text(
@@ -274,13 +293,16 @@ def get_user_conversations(user_id):
     conn.close()
     return conversations
 
+@metrics.timed("db")
 def delete_conversation(conversation_id):
     conn = get_db_connection()
     conn.execute(sqlalchemy.text("DELETE FROM chat_messages WHERE conversation_id = :conversation_id"), {"conversation_id": conversation_id})
+    conn.execute(sqlalchemy.text("DELETE FROM chat_archive_index WHERE conversation_id = :conversation_id"), {"conversation_id": conversation_id})
     conn.execute(sqlalchemy.text("DELETE FROM conversations WHERE id = :conversation_id"), {"conversation_id": conversation_id})
     conn.commit()
     conn.close()
 
+@metrics.timed("db")
 def save_chat_message(conversation_id, role, content):
     conn = get_db_connection()
     conn.execute(sqlalchemy.text(
@@ -289,22 +311,65 @@ def save_chat_message(conversation_id, role, content):
     conn.commit()
     conn.close()
 
+@metrics.timed("db")
 def get_chat_history(conversation_id):
     conn = get_db_connection()
-    messages = conn.execute(sqlalchemy.text(
-        "SELECT role, content FROM chat_messages WHERE conversation_id = :conversation_id ORDER BY timestamp ASC"
-    ), {"conversation_id": conversation_id}).fetchall()
+    # No message predates its conversation, which lets Postgres skip older partitions
+    messages = conn.execute(sqlalchemy.text("""
+    SELECT role, content FROM chat_messages
+    WHERE conversation_id = :conversation_id
+      AND timestamp >= (SELECT created_at FROM conversations WHERE id = :conversation_id)
+    ORDER BY timestamp ASC
+    """), {"conversation_id": conversation_id}).fetchall()
     conn.close()
-    return [{"role": msg[0], "content": msg[1]} for msg in messages]
+    # Months that have been archived are read back from their archive files
+    archived = chat_partitions.archived_messages(conversation_id)
+    return archived + [{"role": msg[0], "content": msg[1]} for msg in messages]
+
+# Verify API key and test API call (once per process; failures are retried on the next rerun)
+@st.cache_resource
+def check_openai_api():
+    return get_chatbot_response([{"role": "user", "content": "Hello, are you working?"}], "gpt-4o-mini")
+
+# Expose metrics over HTTP when METRICS_PORT is set, and in a file when METRICS_FILE is (once per process)
+@st.cache_resource
+def start_metrics_exporters():
+    port = os.getenv("METRICS_PORT")
+    if port:
+        server = metrics.serve(int(port))
+        print(f"Metrics endpoint listening on {server.server_address[0]}:{port}/metrics")  # Debug print
+    # Written from a background thread, so reruns never wait on the disk
+    if os.getenv("METRICS_FILE"):
+        metrics.dump_every(os.getenv("METRICS_FILE"), float(os.getenv("METRICS_FILE_INTERVAL", "15")))
+
+def is_admin(username):
+    admins = [name.strip() for name in os.getenv("ADMIN_USERS", "").split(",") if name.strip()]
+    return username in admins
+
+# Admin-only sidebar panel with call latencies, errors and token usage
+def diagnostics_panel():
+    with st.expander("Diagnostics"):
+        st.caption("Call latencies since the server started")
+        st.dataframe(metrics.summary(), use_container_width=True)
+        st.caption("Token usage")
+        st.dataframe(metrics.token_usage(), use_container_width=True)
+        st.download_button("Download metrics", metrics.render(), file_name="metrics.txt", mime="text/plain")
+
+# Start the password pool and calibrate the bcrypt cost (once per process)
+@st.cache_resource
+def calibrate_password_hashing():
+    return passwords.get_rounds()
 
 # Streamlit app
 def main():
     st.set_page_config(page_title="Snow-Blog", layout="wide")
+    start_metrics_exporters()
     create_tables()
+    calibrate_password_hashing()
 
     # Verify API key and test API call
     try:
-        test_response = get_chatbot_response([{"role": "user", "content": "Hello, are you working?"}], "gpt-4o-mini")
+        test_response = check_openai_api()
         st.success(f"API test successful. Response: {test_response}")
         print(f"API test response: {test_response}")  # Debug print
     except Exception as e:
@@ -399,6 +464,9 @@ def main():
                 st.rerun()
 
             choice = st.radio("Navigation", ["Home", "Create Post", "Image Generation", "Chatbot"])
+
+            if is_admin(st.session_state['username']):
+                diagnostics_panel()
             
         else:
             choice = st.radio("Navigation", ["Home", "Login", "Register"])
@@ -423,7 +491,11 @@ def main():
         username = st.text_input("Username")
         password = st.text_input("Password", type='password')
         if st.button("Login"):
-            user_id = authenticate_user(username, password)
+            try:
+                user_id = authenticate_user(username, password)
+            except (passwords.TooManyAttempts, passwords.PasswordServiceBusy) as e:
+                st.error(str(e))
+                st.stop()
             if user_id:
                 st.success("Logged in successfully")
                 st.session_state['logged_in'] = True
@@ -438,13 +510,18 @@ def main():
         new_user = st.text_input("Username")
         new_password = st.text_input("Password", type='password')
         if st.button("Register"):
+            try:
+                hashed_password = passwords.hash_password(new_password)
+            except passwords.PasswordServiceBusy as e:
+                st.error(str(e))
+                st.stop()
             conn = get_db_connection()
-            hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
             try:
-                conn.execute(sqlalchemy.text(
-                    "INSERT INTO users (username, password) VALUES (:username, :password)"
-                ), {"username": new_user, "password": hashed_password.decode('utf-8')})
-                conn.commit()
+                with metrics.span("db", "register_user"):
+                    conn.execute(sqlalchemy.text(
+                        "INSERT INTO users (username, password) VALUES (:username, :password)"
+                    ), {"username": new_user, "password": hashed_password})
+                    conn.commit()
                 st.success("Account created successfully")
             except sqlalchemy.exc.IntegrityError:
                 st.error("Username already exists")
@@ -0,0 +1,227 @@
+"""Bulk export and import of blog and chat data with Postgres COPY.
+
+    python bulk_data.py export backup/ --format jsonl --compress
+    python bulk_data.py import backup/ --batch-size 50000
+
+Rows are streamed straight between COPY and the files, so memory use stays flat
+however large the tables are. Imports commit every --batch-size rows. Each table
+becomes one file in the directory: <table>.csv or <table>.jsonl, plus .gz if
+compressed. CSV files are Postgres CSV with a header row. JSONL files hold one
+row_to_json() object per line.
+
+chat_archive_index travels with the chat tables, but the archives it points at
+(see chat_partitions.py) are not exported. Copy them to the same location, or
+keep it reachable, for archived conversations to load after an import.
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from chat_partitions import ensure_partitions, is_partitioned
+from db import JSON_COPY_OPTIONS, get_db_connection, get_db_engine
+
+load_dotenv()
+
+# In foreign-key order, so imports never reference a missing row
+TABLES = ["users", "posts", "conversations", "chat_messages", "chat_archive_index"]
+# Tables without a SERIAL id, whose sequence needs no reset after an import
+NO_SEQUENCE_TABLES = {"chat_archive_index"}
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
+
+def _find_file(directory, table):
+    for extension in (".csv", ".csv.gz", ".jsonl", ".jsonl.gz"):
+        path = os.path.join(directory, table + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _csv_records(lines):
+    """Group CSV lines into records; a line break inside quotes continues the record."""
+    record = []
+    quotes = 0
+    for line in lines:
+        record.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b"".join(record)
+            record = []
+            quotes = 0
+    if record:
+        yield b"".join(record)
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_table(cursor, table, path, data_format):
+    if data_format == "csv":
+        # COPY can't read a partitioned table (chat_messages) directly, only a query over it
+        sql = f"COPY (SELECT * FROM {table}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    else:
+        sql = f"COPY (SELECT row_to_json(t) FROM {table} t) TO STDOUT WITH ({JSON_COPY_OPTIONS})"
+    with _open(path, "wb") as f:
+        cursor.execute(sql, stream=f)
+    return cursor.rowcount
+
+
+def import_csv(conn, cursor, table, f, batch_size):
+    records = _csv_records(f)
+    header = next(records, None)
+    if header is None:
+        return 0
+    columns = header.decode("utf-8").strip()
+
+    total = 0
+    for batch in _batches(records, batch_size):
+        cursor.execute(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", stream=io.BytesIO(b"".join(batch)))
+        conn.commit()
+        total += len(batch)
+    return total
+
+
+def import_jsonl(conn, cursor, table, f, batch_size):
+    # Each batch is staged as raw JSON, then expanded into typed rows by Postgres
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_rows (doc json)")
+    total = 0
+    for batch in _batches((line for line in f if line.strip()), batch_size):
+        cursor.execute(f"COPY import_rows (doc) FROM STDIN WITH ({JSON_COPY_OPTIONS})", stream=io.BytesIO(b"".join(batch)))
+        cursor.execute(f"INSERT INTO {table} SELECT r.* FROM import_rows, json_populate_record(NULL::{table}, doc) r")
+        cursor.execute("TRUNCATE import_rows")
+        conn.commit()
+        total += len(batch)
+    return total
+
+
+def reset_sequence(conn, cursor, table):
+    # Imported rows keep their ids, so move the SERIAL sequence past them
+    cursor.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+    )
+    conn.commit()
+
+
+def run_export(conn, args):
+    os.makedirs(args.directory, exist_ok=True)
+    cursor = conn.cursor()
+    # One snapshot for every table, so the files are consistent with each other
+    conn.rollback()
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    extension = f".{args.format}" + (".gz" if args.compress else "")
+    for table in args.tables:
+        start = time.monotonic()
+        path = os.path.join(args.directory, table + extension)
+        rows = export_table(cursor, table, path, args.format)
+        print(f"Exported {rows} rows from {table} to {path} in {time.monotonic() - start:.1f}s")
+    conn.commit()
+
+    if "chat_archive_index" in args.tables:
+        cursor.execute("SELECT COUNT(DISTINCT location) FROM chat_archive_index")
+        archives = cursor.fetchone()[0]
+        if archives:
+            print(f"chat_archive_index points at {archives} archive files that were not exported; "
+                  f"copy them along for archived conversations to load")
+
+
+def run_import(conn, args):
+    cursor = conn.cursor()
+    if args.truncate:
+        tables = list(args.tables)
+        if ("conversations" in tables or "chat_messages" in tables) and "chat_archive_index" not in tables:
+            # Old index rows would attach archived messages to the reused conversation ids
+            tables.append("chat_archive_index")
+        cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+        conn.commit()
+
+    for table in args.tables:
+        path = _find_file(args.directory, table)
+        if path is None:
+            print(f"Skipping {table}: no file in {args.directory}")
+            continue
+        start = time.monotonic()
+        with _open(path, "rb") as f:
+            if ".jsonl" in path:
+                rows = import_jsonl(conn, cursor, table, f, args.batch_size)
+            else:
+                rows = import_csv(conn, cursor, table, f, args.batch_size)
+        if table not in NO_SEQUENCE_TABLES:
+            reset_sequence(conn, cursor, table)
+        print(f"Imported {rows} rows into {table} from {path} in {time.monotonic() - start:.1f}s")
+
+    if "chat_messages" in args.tables:
+        # Imported months without a partition landed in chat_messages_default; give them their own
+        partition_conn = get_db_connection()
+        try:
+            if is_partitioned(partition_conn):
+                ensure_partitions(partition_conn, move_default_rows=True)
+                partition_conn.commit()
+        finally:
+            partition_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk export and import of Snow-Blog data with Postgres COPY")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write tables to files")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export_parser.add_argument("--compress", action="store_true", help="gzip the files")
+
+    import_parser = subparsers.add_parser("import", help="load tables from files written by export")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--batch-size", type=int, default=10000, help="rows per COPY and commit")
+    import_parser.add_argument("--truncate", action="store_true",
+                               help="empty the tables first (CASCADE also empties tables that reference them, e.g. image_jobs; "
+                                    "emptying conversations or chat_messages also empties chat_archive_index)")
+
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument("--tables", nargs="+", choices=TABLES, default=TABLES)
+
+    args = parser.parse_args()
+    # Keep foreign-key order whatever order the tables were given in
+    args.tables = [table for table in TABLES if table in args.tables]
+
+    engine = get_db_engine()
+    if engine.dialect.name != "postgresql":
+        print(f"COPY needs Postgres; DATABASE_URL points at {engine.dialect.name}")
+        return 1
+    if engine.dialect.driver != "pg8000":
+        # Streaming COPY through cursor.execute(..., stream=f) is a pg8000 feature
+        print(f"COPY streaming needs the pg8000 driver; DATABASE_URL uses {engine.dialect.driver} "
+              f"(use postgresql+pg8000://...)")
+        return 1
+
+    # COPY ... STDIN/STDOUT goes through the pg8000 driver connection directly
+    conn = engine.raw_connection()
+    try:
+        if args.command == "export":
+            run_export(conn, args)
+        else:
+            run_import(conn, args)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,428 @@
+"""Monthly partitions of chat_messages, with archival of old months.
+
+On Postgres, chat_messages is range-partitioned by month on `timestamp`, so each
+month's rows and indexes live in their own table (chat_messages_p2024_07 etc.).
+Old months can be archived: their rows are written to a gzipped JSONL file on
+local disk or in Google Cloud Storage, indexed per conversation in
+chat_archive_index, and the partition is detached and dropped.
+archived_messages() reads a conversation back from those files on demand.
+
+    python chat_partitions.py migrate            # convert an existing unpartitioned table
+    python chat_partitions.py ensure             # create partitions for the coming months (run daily)
+    python chat_partitions.py archive --keep-months 6 --destination gs://streamlit-blog/chat-archive
+"""
+import argparse
+import functools
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from datetime import date, datetime
+
+import sqlalchemy
+from dotenv import load_dotenv
+
+import metrics
+from db import JSON_COPY_OPTIONS, get_db_connection, get_db_engine
+
+load_dotenv()
+
+# Partitions are created this many months ahead of the current one
+MONTHS_AHEAD = 2
+PARTITION_RE = re.compile(r"^chat_messages_p(\d{4})_(\d{2})$")
+
+
+def _month_start(day, offset=0):
+    month = day.month - 1 + offset
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"chat_messages_p{month:%Y_%m}"
+
+
+def create_table(conn):
+    if conn.dialect.name == "postgresql":
+        conn.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id SERIAL,
+            conversation_id INTEGER REFERENCES conversations(id),
+            role VARCHAR(10) NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+        """))
+        partitioned = is_partitioned(conn)
+    else:
+        conn.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id SERIAL PRIMARY KEY,
+            conversation_id INTEGER REFERENCES conversations(id),
+            role VARCHAR(10) NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """))
+        partitioned = False
+    # An old unpartitioned Postgres table gets its index from migrate(), not from a blocking build at app start
+    if conn.dialect.name != "postgresql" or partitioned:
+        conn.execute(sqlalchemy.text(
+            "CREATE INDEX IF NOT EXISTS chat_messages_conversation_idx ON chat_messages (conversation_id, timestamp)"
+        ))
+
+    create_archive_index(conn)
+
+    if conn.dialect.name == "postgresql":
+        if partitioned:
+            ensure_partitions(conn)
+        else:
+            print("chat_messages is not partitioned; run `python chat_partitions.py migrate`")
+
+
+def create_archive_index(conn):
+    conn.execute(sqlalchemy.text("""
+    CREATE TABLE IF NOT EXISTS chat_archive_index (
+        conversation_id INTEGER NOT NULL,
+        partition_name VARCHAR(63) NOT NULL,
+        location TEXT NOT NULL,
+        byte_offset BIGINT NOT NULL,
+        byte_length BIGINT NOT NULL,
+        message_count INTEGER NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """))
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS chat_archive_index_conversation_idx ON chat_archive_index (conversation_id)"
+    ))
+
+
+def is_partitioned(conn):
+    relkind = conn.execute(sqlalchemy.text(
+        "SELECT relkind FROM pg_class WHERE oid = 'chat_messages'::regclass"
+    )).scalar()
+    return relkind == "p"
+
+
+def list_partitions(conn):
+    return [row[0] for row in conn.execute(sqlalchemy.text("""
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'chat_messages'::regclass
+    ORDER BY c.relname
+    """))]
+
+
+def _create_partition_sql(month):
+    return (
+        f"CREATE TABLE {partition_name(month)} PARTITION OF chat_messages "
+        f"FOR VALUES FROM ('{month}') TO ('{_month_start(month, 1)}')"
+    )
+
+
+def _move_out_of_default(conn, months):
+    """Create partitions for the months that have rows in the default partition, and move those rows into them."""
+    # Postgres won't create a partition while the default holds rows for its range, so detach the default meanwhile
+    conn.execute(sqlalchemy.text("ALTER TABLE chat_messages DETACH PARTITION chat_messages_default"))
+    for month in months:
+        conn.execute(sqlalchemy.text(_create_partition_sql(month)))
+    result = conn.execute(sqlalchemy.text("""
+    INSERT INTO chat_messages (id, conversation_id, role, content, timestamp)
+    SELECT id, conversation_id, role, content, timestamp FROM chat_messages_default
+    """))
+    conn.execute(sqlalchemy.text("TRUNCATE chat_messages_default"))
+    conn.execute(sqlalchemy.text("ALTER TABLE chat_messages ATTACH PARTITION chat_messages_default DEFAULT"))
+    print(f"Moved {result.rowcount} messages out of the default partition")
+
+
+def ensure_partitions(conn, months_ahead=MONTHS_AHEAD, first_month=None, move_default_rows=False):
+    """Create the monthly partitions from first_month (default: this month) through months_ahead, plus a default.
+
+    With move_default_rows, months that already have rows in the default partition
+    (written past the last partition, or imported) also get their own partitions
+    and the rows are moved there. That locks chat_messages for the whole move, so
+    it is left to `python chat_partitions.py ensure` and never done at app start.
+    """
+    existing = set(list_partitions(conn))
+    month = first_month or _month_start(date.today())
+    last_month = _month_start(date.today(), months_ahead)
+
+    if move_default_rows and "chat_messages_default" in existing:
+        stranded = [row[0] for row in conn.execute(sqlalchemy.text(
+            "SELECT DISTINCT date_trunc('month', timestamp)::date FROM chat_messages_default ORDER BY 1"
+        ))]
+        if stranded:
+            try:
+                with conn.begin_nested():
+                    _move_out_of_default(conn, stranded)
+                existing.update(partition_name(month) for month in stranded)
+            except sqlalchemy.exc.DBAPIError as e:
+                print(f"Could not move messages out of the default partition: {str(e)}")
+
+    statements = []
+    while month <= last_month:
+        if partition_name(month) not in existing:
+            statements.append(_create_partition_sql(month))
+        month = _month_start(month, 1)
+    # Catches rows outside every monthly range instead of failing the insert
+    if "chat_messages_default" not in existing:
+        statements.append("CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT")
+
+    for statement in statements:
+        try:
+            with conn.begin_nested():
+                conn.execute(sqlalchemy.text(statement))
+        except sqlalchemy.exc.DBAPIError as e:
+            # Usually rows for that month already sit in the default partition; `ensure` moves them
+            print(f"Could not create partition: {str(e)}")
+
+
+def migrate(conn):
+    """Move an unpartitioned chat_messages table into monthly partitions, keeping ids."""
+    if is_partitioned(conn):
+        print("chat_messages is already partitioned")
+        return
+
+    first = conn.execute(sqlalchemy.text("SELECT MIN(timestamp) FROM chat_messages")).scalar()
+    conn.execute(sqlalchemy.text("ALTER TABLE chat_messages RENAME TO chat_messages_unpartitioned"))
+    # The new table reuses these names, so move the old ones out of the way
+    conn.execute(sqlalchemy.text("ALTER TABLE chat_messages_unpartitioned RENAME CONSTRAINT chat_messages_pkey TO chat_messages_unpartitioned_pkey"))
+    conn.execute(sqlalchemy.text("ALTER TABLE chat_messages_unpartitioned RENAME CONSTRAINT chat_messages_conversation_id_fkey TO chat_messages_unpartitioned_conversation_id_fkey"))
+    conn.execute(sqlalchemy.text("ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE"))
+    conn.execute(sqlalchemy.text("ALTER INDEX IF EXISTS chat_messages_conversation_idx RENAME TO chat_messages_unpartitioned_conversation_idx"))
+    conn.execute(sqlalchemy.text("""
+    CREATE TABLE chat_messages (
+        id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+        conversation_id INTEGER REFERENCES conversations(id),
+        role VARCHAR(10) NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+    """))
+    conn.execute(sqlalchemy.text("ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id"))
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX chat_messages_conversation_idx ON chat_messages (conversation_id, timestamp)"
+    ))
+    ensure_partitions(conn, first_month=_month_start(first) if first else None)
+
+    result = conn.execute(sqlalchemy.text("""
+    INSERT INTO chat_messages (id, conversation_id, role, content, timestamp)
+    SELECT id, conversation_id, role, content, COALESCE(timestamp, CURRENT_TIMESTAMP) FROM chat_messages_unpartitioned
+    """))
+    conn.execute(sqlalchemy.text("DROP TABLE chat_messages_unpartitioned"))
+    print(f"Moved {result.rowcount} messages into monthly partitions")
+
+
+class _ArchiveWriter:
+    """File-like sink for COPY output: one gzip member per conversation, with its offset recorded."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = b""
+        self.conversation_id = None
+        self.lines = []
+        self.offset = 0
+        self.count = 0
+        self.index = []  # (conversation_id, byte_offset, byte_length, message_count)
+
+    def write(self, data):
+        self.buffer += bytes(data)
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            if line:
+                self._add(line)
+        return len(data)
+
+    def _add(self, line):
+        conversation_id = json.loads(line)["conversation_id"]
+        if conversation_id != self.conversation_id:
+            self._flush()
+            self.conversation_id = conversation_id
+        self.lines.append(line + b"\n")
+
+    def _flush(self):
+        if not self.lines:
+            return
+        member = gzip.compress(b"".join(self.lines))
+        self.f.write(member)
+        # Messages without a conversation are kept in the file but can never be looked up, so they get no index entry
+        if self.conversation_id is not None:
+            self.index.append((self.conversation_id, self.offset, len(member), len(self.lines)))
+        self.offset += len(member)
+        self.count += len(self.lines)
+        self.lines = []
+
+    def close(self):
+        if self.buffer:
+            self._add(self.buffer)
+            self.buffer = b""
+        self._flush()
+
+
+def _store(local_path, destination, file_name):
+    """Copy the finished archive to a local directory or gs://bucket/prefix and return its location."""
+    if destination.startswith("gs://"):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = destination[len("gs://"):].partition("/")
+        blob_name = f"{prefix.rstrip('/')}/{file_name}" if prefix else file_name
+        storage.Client().bucket(bucket_name).blob(blob_name).upload_from_filename(local_path, content_type="application/gzip")
+        return f"gs://{bucket_name}/{blob_name}"
+
+    os.makedirs(destination, exist_ok=True)
+    path = os.path.abspath(os.path.join(destination, file_name))
+    shutil.copyfile(local_path, path)
+    return path
+
+
+def _remove(location):
+    """Delete an archive written by _store()."""
+    if location.startswith("gs://"):
+        from google.cloud import storage
+
+        bucket_name, _, blob_name = location[len("gs://"):].partition("/")
+        storage.Client().bucket(bucket_name).blob(blob_name).delete()
+    else:
+        os.remove(location)
+
+
+def archive_partition(name, destination):
+    """Archive one partition, then detach and drop it. Returns the number of messages archived."""
+    with tempfile.NamedTemporaryFile(suffix=".jsonl.gz") as tmp:
+        # Rows are grouped by conversation so each gets one contiguous gzip member
+        raw = get_db_engine().raw_connection()
+        try:
+            writer = _ArchiveWriter(tmp)
+            cursor = raw.cursor()
+            cursor.execute(
+                f"COPY (SELECT row_to_json(t) FROM (SELECT * FROM {name} ORDER BY conversation_id, timestamp, id) t) "
+                f"TO STDOUT WITH ({JSON_COPY_OPTIONS})",
+                stream=writer,
+            )
+            writer.close()
+            raw.commit()
+        finally:
+            raw.close()
+        tmp.flush()
+        # Timestamped, since a month moved out of the default partition can be archived a second time
+        location = _store(tmp.name, destination, f"{name}_{datetime.utcnow():%Y%m%d%H%M%S}.jsonl.gz")
+
+    archived = writer.count
+    conn = get_db_connection()
+    try:
+        conn.execute(sqlalchemy.text(f"ALTER TABLE chat_messages DETACH PARTITION {name}"))
+        count = conn.execute(sqlalchemy.text(f"SELECT COUNT(*) FROM {name}")).scalar()
+        if count != archived:
+            raise Exception(f"{name} has {count} rows but {archived} were archived; leaving it attached")
+        if writer.index:
+            conn.execute(sqlalchemy.text("""
+            INSERT INTO chat_archive_index (conversation_id, partition_name, location, byte_offset, byte_length, message_count)
+            VALUES (:conversation_id, :partition_name, :location, :byte_offset, :byte_length, :message_count)
+            """), [
+                {"conversation_id": conversation_id, "partition_name": name, "location": location,
+                 "byte_offset": byte_offset, "byte_length": byte_length, "message_count": message_count}
+                for conversation_id, byte_offset, byte_length, message_count in writer.index
+            ])
+        conn.execute(sqlalchemy.text(f"DROP TABLE {name}"))
+        conn.commit()
+    except Exception:
+        # Nothing was dropped, so the file would only be a stray copy next to the next attempt's
+        conn.rollback()
+        _remove(location)
+        raise
+    finally:
+        conn.close()
+    return archived
+
+
+def archive_old_partitions(keep_months, destination):
+    cutoff = _month_start(date.today(), -keep_months)
+    conn = get_db_connection()
+    partitions = list_partitions(conn)
+    conn.close()
+
+    for name in partitions:
+        match = PARTITION_RE.match(name)
+        if not match:
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        if _month_start(month, 1) <= cutoff:
+            archived = archive_partition(name, destination)
+            print(f"Archived {archived} messages from {name} to {destination}")
+
+
+@functools.lru_cache(maxsize=128)
+def _read_member(location, byte_offset, byte_length):
+    # Archives never change once written, so members can be cached for the life of the process
+    with metrics.span("archive", "read_member"):
+        if location.startswith("gs://"):
+            from google.cloud import storage
+
+            bucket_name, _, blob_name = location[len("gs://"):].partition("/")
+            blob = storage.Client().bucket(bucket_name).blob(blob_name)
+            data = blob.download_as_bytes(start=byte_offset, end=byte_offset + byte_length - 1)
+        else:
+            with open(location, "rb") as f:
+                f.seek(byte_offset)
+                data = f.read(byte_length)
+    return gzip.decompress(data)
+
+
+@metrics.timed("db")
+def _archive_entries(conversation_id):
+    conn = get_db_connection()
+    entries = conn.execute(sqlalchemy.text(
+        "SELECT location, byte_offset, byte_length FROM chat_archive_index WHERE conversation_id = :conversation_id ORDER BY partition_name"
+    ), {"conversation_id": conversation_id}).fetchall()
+    conn.close()
+    return entries
+
+
+def archived_messages(conversation_id):
+    """Messages of a conversation that have been archived, oldest first."""
+    messages = []
+    for location, byte_offset, byte_length in _archive_entries(conversation_id):
+        for line in _read_member(location, byte_offset, byte_length).splitlines():
+            doc = json.loads(line)
+            messages.append({"role": doc["role"], "content": doc["content"]})
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain monthly chat_messages partitions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="convert an unpartitioned chat_messages table")
+    ensure_parser = subparsers.add_parser("ensure", help="create partitions for the coming months")
+    ensure_parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    archive_parser = subparsers.add_parser("archive", help="archive, detach and drop old partitions")
+    archive_parser.add_argument("--keep-months", type=int, default=6, help="full months to keep in the database")
+    archive_parser.add_argument("--destination", default=os.getenv("CHAT_ARCHIVE_DESTINATION", "chat-archive"),
+                                help="local directory or gs://bucket/prefix (default: CHAT_ARCHIVE_DESTINATION or ./chat-archive)")
+    args = parser.parse_args()
+
+    if get_db_engine().dialect.name != "postgresql":
+        print("Partitioning needs Postgres")
+        return 1
+
+    conn = get_db_connection()
+    try:
+        # migrate and archive both record into chat_archive_index, which may predate the app's create_tables()
+        create_archive_index(conn)
+        if args.command == "migrate":
+            migrate(conn)
+        elif args.command == "ensure":
+            ensure_partitions(conn, args.months_ahead, move_default_rows=True)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if args.command == "archive":
+        archive_old_partitions(args.keep_months, args.destination)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,20 +2,24 @@ import streamlit as st
 from openai import OpenAI
 import os
 
+import metrics
+
 # Initialize OpenAI client
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 def analyze_sentiment(user_input, model):
     """Analyze the sentiment of the user input using OpenAI."""
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "Analyze the sentiment of the following text. Respond with only 'positive', 'neutral', or 'negative'."},
-                {"role": "user", "content": user_input}
-            ],
-            max_tokens=10
-        )
+        with metrics.span("llm", "analyze_sentiment"):
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "Analyze the sentiment of the following text. Respond with only 'positive', 'neutral', or 'negative'."},
+                    {"role": "user", "content": user_input}
+                ],
+                max_tokens=10
+            )
+        metrics.record_tokens(model, getattr(response, "usage", None))
         sentiment = response.choices[0].message.content.strip().lower()
         return sentiment
     except Exception as e:
@@ -49,10 +53,12 @@ def enhanced_chatbot_response(user_input, history, model):
         ]
 
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages
-            )
+            with metrics.span("llm", "enhanced_chatbot_response"):
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages
+                )
+            metrics.record_tokens(model, getattr(response, "usage", None))
             return response.choices[0].message.content
         except Exception as e:
             error_message = f"Error in enhanced_chatbot_response: {str(e)}"
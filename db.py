@@ -0,0 +1,53 @@
+"""Database engine shared by the Streamlit app, image_worker.py and the maintenance scripts."""
+import os
+import threading
+
+import pg8000
+import sqlalchemy
+
+# CSV options for COPY that never quote or escape, so row_to_json() output passes through untouched
+JSON_COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def create_db_engine():
+    pool_options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_pre_ping": True
+    }
+
+    # DATABASE_URL points the app at another database, e.g. a local Postgres or the SQLite stand-in used by benchmark.py
+    database_url = os.getenv("DATABASE_URL")
+    if database_url:
+        return sqlalchemy.create_engine(database_url, **pool_options)
+
+    db_config = {
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        "host": "127.0.0.1",  # Use localhost when using Cloud SQL proxy
+        "port": 5432
+    }
+
+    return sqlalchemy.create_engine(
+        "postgresql+pg8000://",
+        creator=lambda: pg8000.connect(**db_config),
+        **pool_options
+    )
+
+
+# One engine per process, so every session and worker thread shares a single pool
+def get_db_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_db_engine()
+        return _engine
+
+
+def get_db_connection():
+    return get_db_engine().connect()
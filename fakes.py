@@ -0,0 +1,272 @@
+"""In-process stand-ins for OpenAI, fal, Google Cloud Storage and the database.
+
+Used by benchmark.py so the app can be driven end to end without network access.
+Every call that would have left the process is counted in `calls`.
+"""
+import contextlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock
+
+import bcrypt
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Counts of external calls and database statements, keyed by kind
+calls = Counter()
+_calls_lock = threading.Lock()
+
+# Artificial latency (in seconds) added to each fake external call
+latencies = {"llm": 0.0, "fal": 0.0, "gcs": 0.0}
+
+_DDL_RE = re.compile(r"^\s*(CREATE|ALTER|DROP|DO)\b", re.IGNORECASE)
+
+# SQLite equivalent of create_tables(); the app's own DDL then becomes a no-op
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password VARCHAR(255) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title VARCHAR(100) NOT NULL,
+        content TEXT NOT NULL,
+        author_id INTEGER REFERENCES users(id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        image_url TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES users(id),
+        title VARCHAR(100) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER REFERENCES conversations(id),
+        role VARCHAR(10) NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS image_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES users(id),
+        model VARCHAR(50) NOT NULL,
+        prompt TEXT NOT NULL,
+        arguments TEXT NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued',
+        image_url TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """,
+]
+
+
+def record(kind, n=1):
+    with _calls_lock:
+        calls[kind] += n
+
+
+def snapshot():
+    with _calls_lock:
+        return dict(calls)
+
+
+# OpenAI
+class FakeOpenAI:
+    """Echoes the last message back, with word counts as token usage."""
+
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key or "sk-fake"
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        record("llm")
+        time.sleep(latencies["llm"])
+        reply = f"[{model}] {messages[-1]['content']}"
+        prompt_tokens = sum(len(str(msg["content"]).split()) for msg in messages)
+        completion_tokens = len(reply.split())
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+        message = SimpleNamespace(role="assistant", content=reply)
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+# Google Cloud Storage
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def upload_from_string(self, data, content_type=None):
+        record("gcs")
+        time.sleep(latencies["gcs"])
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.objects[self.name] = data
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def download_as_bytes(self, start=None, end=None):
+        record("gcs")
+        time.sleep(latencies["gcs"])
+        data = self.bucket.objects[self.name]
+        # Like GCS, `end` is inclusive
+        return data[start or 0:None if end is None else end + 1]
+
+    def delete(self):
+        record("gcs")
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeStorageClient:
+    # Buckets are shared by every client so uploads are visible across sessions
+    _buckets = {}
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(name)
+            return self._buckets[name]
+
+
+# fal
+class FakeQueued:
+    pass
+
+
+class FakeInProgress:
+    pass
+
+
+class FakeCompleted:
+    pass
+
+
+class FakeFalHandler:
+    def __init__(self, application, arguments):
+        self.application = application
+        self.arguments = arguments
+        self.request_id = str(uuid.uuid4())
+        self._ready_at = time.monotonic() + latencies["fal"]
+
+    def status(self, *args, **kwargs):
+        if time.monotonic() >= self._ready_at:
+            return FakeCompleted()
+        return FakeInProgress()
+
+    def get(self):
+        return {"images": [{"url": f"https://fal.media/files/fake/{self.request_id}.png"}]}
+
+
+def fake_fal_submit(application, arguments, **kwargs):
+    record("fal")
+    record("fal_payload_bytes", len(json.dumps(arguments)))
+    return FakeFalHandler(application, arguments)
+
+
+# Database
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record("db_queries")
+    if _DDL_RE.match(statement):
+        record("db_ddl")
+    # SQLite has no DO blocks; the column they add is already in SQLITE_SCHEMA
+    if conn.dialect.name == "sqlite" and statement.lstrip().startswith("DO $$"):
+        statement = "SELECT 1"
+    return statement, parameters
+
+
+def sqlite_url(path=None):
+    """Return a URL for a throwaway SQLite database file."""
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="snowblog-bench-", suffix=".db")
+        os.close(fd)
+    return f"sqlite:///{path}?timeout=30"
+
+
+def prepare_database(database_url):
+    """Create the SQLite schema up front; Postgres gets it from create_tables()."""
+    engine = sqlalchemy.create_engine(database_url)
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            for ddl in SQLITE_SCHEMA:
+                conn.execute(sqlalchemy.text(ddl))
+    engine.dispose()
+
+
+def seed_user(database_url, username, password):
+    engine = sqlalchemy.create_engine(database_url)
+    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text(
+            "INSERT INTO users (username, password) VALUES (:username, :password) "
+            "ON CONFLICT (username) DO NOTHING"
+        ), {"username": username, "password": hashed_password.decode('utf-8')})
+    engine.dispose()
+
+
+@contextlib.contextmanager
+def installed(database_url):
+    """Patch the external clients and point the app at `database_url`."""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(os.environ, {
+            "DATABASE_URL": database_url,
+            "OPENAI_API_KEY": "sk-fake-benchmark",
+            "FAL_KEY": "fal-fake-benchmark",
+        }))
+        stack.enter_context(mock.patch("openai.OpenAI", FakeOpenAI))
+        stack.enter_context(mock.patch("google.cloud.storage.Client", FakeStorageClient))
+        stack.enter_context(mock.patch("fal_client.submit", fake_fal_submit))
+        stack.enter_context(mock.patch("fal_client.Queued", FakeQueued))
+        stack.enter_context(mock.patch("fal_client.InProgress", FakeInProgress))
+        stack.enter_context(mock.patch("fal_client.Completed", FakeCompleted))
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute, retval=True)
+        stack.callback(event.remove, Engine, "before_cursor_execute", _before_cursor_execute)
+        yield
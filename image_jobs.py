@@ -0,0 +1,132 @@
+"""Queue of image generation jobs, stored in the image_jobs table.
+
+The Streamlit page enqueues jobs and polls their status; image_worker.py claims
+and runs them. Because jobs live in the database they survive reruns, page
+reloads and restarts of either process.
+"""
+import json
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy
+
+import metrics
+from db import get_db_connection
+
+PENDING_STATUSES = ("queued", "running")
+
+# Models offered on the page, and the fal application each one runs on
+fal_models = {
+    "flux-dev": "fal-ai/flux/dev",
+    "sd-v3-medium": "fal-ai/stable-diffusion-v3-medium",
+    "flux-realism": "fal-ai/flux-realism",
+    "flux-lora": "fal-ai/flux-lora",
+    "flux-dev-image-to-image": "fal-ai/flux/dev/image-to-image",
+    "lora-image-to-image": "fal-ai/lora/image-to-image",
+    "fast-sdxl": "fal-ai/fast-sdxl"
+}
+
+
+def _now():
+    # Naive UTC, written by Python so Postgres and SQLite agree on the clock
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def create_table(conn):
+    conn.execute(sqlalchemy.text("""
+    CREATE TABLE IF NOT EXISTS image_jobs (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        model VARCHAR(50) NOT NULL,
+        prompt TEXT NOT NULL,
+        arguments TEXT NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued',
+        image_url TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """))
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS image_jobs_status_idx ON image_jobs (status, id)"
+    ))
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS image_jobs_user_idx ON image_jobs (user_id, id)"
+    ))
+
+
+@metrics.timed("db")
+def enqueue_job(user_id, model, prompt, arguments):
+    conn = get_db_connection()
+    result = conn.execute(sqlalchemy.text(
+        "INSERT INTO image_jobs (user_id, model, prompt, arguments) VALUES (:user_id, :model, :prompt, :arguments) RETURNING id"
+    ), {"user_id": user_id, "model": model, "prompt": prompt, "arguments": json.dumps(arguments)})
+    job_id = result.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+@metrics.timed("db")
+def get_user_jobs(user_id, limit=12):
+    """Most recent jobs first."""
+    conn = get_db_connection()
+    jobs = conn.execute(sqlalchemy.text(
+        "SELECT id, status, prompt, image_url, error FROM image_jobs WHERE user_id = :user_id ORDER BY id DESC LIMIT :limit"
+    ), {"user_id": user_id, "limit": limit}).fetchall()
+    conn.close()
+    return jobs
+
+
+@metrics.timed("db")
+def claim_next_job():
+    """Mark the oldest queued job as running and return it, or None if the queue is empty."""
+    conn = get_db_connection()
+    # SKIP LOCKED lets several workers claim jobs concurrently; SQLite serializes writers anyway
+    lock_clause = "FOR UPDATE SKIP LOCKED" if conn.dialect.name == "postgresql" else ""
+    job = conn.execute(sqlalchemy.text(f"""
+    UPDATE image_jobs SET status = 'running', attempts = attempts + 1, started_at = :now
+    WHERE id = (
+        SELECT id FROM image_jobs WHERE status = 'queued' ORDER BY id LIMIT 1 {lock_clause}
+    )
+    RETURNING id, model, arguments
+    """), {"now": _now()}).fetchone()
+    conn.commit()
+    conn.close()
+    return job
+
+
+@metrics.timed("db")
+def complete_job(job_id, image_url):
+    conn = get_db_connection()
+    conn.execute(sqlalchemy.text(
+        "UPDATE image_jobs SET status = 'completed', image_url = :image_url, finished_at = :now WHERE id = :job_id"
+    ), {"job_id": job_id, "image_url": image_url, "now": _now()})
+    conn.commit()
+    conn.close()
+
+
+@metrics.timed("db")
+def fail_job(job_id, error):
+    conn = get_db_connection()
+    conn.execute(sqlalchemy.text(
+        "UPDATE image_jobs SET status = 'failed', error = :error, finished_at = :now WHERE id = :job_id"
+    ), {"job_id": job_id, "error": error, "now": _now()})
+    conn.commit()
+    conn.close()
+
+
+@metrics.timed("db")
+def requeue_stale_jobs(older_than_seconds, max_attempts):
+    """Put back jobs whose worker died mid-run; give up after max_attempts."""
+    conn = get_db_connection()
+    result = conn.execute(sqlalchemy.text("""
+    UPDATE image_jobs
+    SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'queued' END,
+        error = CASE WHEN attempts >= :max_attempts THEN 'Worker stopped before the job finished' ELSE error END
+    WHERE status = 'running' AND started_at < :cutoff
+    """), {"max_attempts": max_attempts, "cutoff": _now() - timedelta(seconds=older_than_seconds)})
+    conn.commit()
+    conn.close()
+    return result.rowcount
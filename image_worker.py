@@ -0,0 +1,130 @@
+"""Worker process that runs queued image generation jobs against fal.
+
+    python image_worker.py --concurrency 4
+
+Each worker thread claims one job at a time from image_jobs, submits it to fal,
+polls until it finishes and stores the resulting image URL (or the error).
+"""
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+
+import fal_client
+from dotenv import load_dotenv
+
+import image_jobs
+import metrics
+from image_jobs import fal_models
+
+load_dotenv()
+fal_client.api_key = os.getenv('FAL_KEY')
+
+
+def generate_image_fal(model, arguments, max_attempts=60, poll_interval=1):
+    """Submit a job to fal and wait for it; returns the image URL or None."""
+    with metrics.span("fal", model):
+        handler = fal_client.submit(
+            fal_models[model],
+            arguments=arguments,
+        )
+
+        for _ in range(max_attempts):
+            status = handler.status()
+
+            if isinstance(status, fal_client.Completed):
+                result = handler.get()
+                if result and 'images' in result and len(result['images']) > 0:
+                    return result['images'][0]['url']
+                else:
+                    return None
+            elif isinstance(status, (fal_client.InProgress, fal_client.Queued)):
+                time.sleep(poll_interval)
+            else:
+                raise Exception(f"Unknown status: {status}")
+
+        raise Exception("Timeout: Image generation took too long")
+
+
+def run_job(job):
+    try:
+        image_url = generate_image_fal(job.model, json.loads(job.arguments))
+        if image_url:
+            image_jobs.complete_job(job.id, image_url)
+        else:
+            image_jobs.fail_job(job.id, "fal returned no image")
+    except Exception as e:
+        print(f"Image job {job.id} failed: {str(e)}")  # Debug print
+        image_jobs.fail_job(job.id, str(e))
+
+
+def run_once():
+    """Claim and run a single job. Returns False if the queue was empty."""
+    job = image_jobs.claim_next_job()
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+def work(stop_event, poll_interval):
+    while not stop_event.is_set():
+        try:
+            if not run_once():
+                stop_event.wait(poll_interval)
+        except Exception as e:
+            # Database hiccups should not kill the worker thread
+            print(f"Image worker error: {str(e)}")  # Debug print
+            stop_event.wait(poll_interval)
+
+
+def run(concurrency, poll_interval, stop_event, stale_after=300, max_attempts=3):
+    """Run `concurrency` worker threads until stop_event is set."""
+    threads = [
+        threading.Thread(target=work, args=(stop_event, poll_interval), name=f"image-worker-{i}", daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Jobs left running by a crashed or restarted worker go back on the queue
+    while not stop_event.is_set():
+        try:
+            requeued = image_jobs.requeue_stale_jobs(stale_after, max_attempts)
+            if requeued:
+                print(f"Requeued {requeued} stale image jobs")  # Debug print
+        except Exception as e:
+            print(f"Image worker error: {str(e)}")  # Debug print
+        stop_event.wait(stale_after / 2)
+
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued image generation jobs")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("IMAGE_WORKER_CONCURRENCY", "2")),
+                        help="jobs to run at once (default: IMAGE_WORKER_CONCURRENCY or 2)")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds to wait when the queue is empty")
+    parser.add_argument("--stale-after", type=float, default=300, help="seconds before a running job is considered abandoned")
+    parser.add_argument("--max-attempts", type=int, default=3, help="times a job is retried after its worker dies")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    args = parser.parse_args()
+
+    if 'FAL_KEY' not in os.environ:
+        print("FAL_KEY is not set in the environment variables; jobs will fail.")
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    print(f"Image worker started with concurrency {args.concurrency}")
+    run(args.concurrency, args.poll_interval, stop_event, args.stale_after, args.max_attempts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Input images for image-to-image models.
+
+Uploads are downscaled to the model's working resolution and stored once in
+Google Cloud Storage under their content hash, so a fal job carries a short URL
+instead of a base64 data URI, and resubmitting the same image reuses the upload.
+"""
+import hashlib
+import io
+import threading
+
+from google.cloud import storage
+from PIL import Image, ImageOps
+
+import metrics
+
+BUCKET_NAME = "streamlit-blog"
+INPUT_PREFIX = "image-inputs"
+
+# Longest side, in pixels, each model works at; anything larger is scaled down by fal anyway
+MODEL_MAX_SIDE = {
+    "flux-dev-image-to-image": 1024,
+    "lora-image-to-image": 1024,
+}
+DEFAULT_MAX_SIDE = 1024
+
+_bucket = None
+_urls = {}  # content key -> public URL, for uploads this process has already made or found
+_lock = threading.Lock()
+
+
+def _get_bucket():
+    global _bucket
+    with _lock:
+        if _bucket is None:
+            _bucket = storage.Client().bucket(BUCKET_NAME)
+        return _bucket
+
+
+def downscale(data, max_side):
+    """Return `data` as a JPEG no larger than max_side on its longest side."""
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def input_image_url(data, model):
+    """Public URL of `data` prepared for `model`, uploading it only the first time."""
+    max_side = MODEL_MAX_SIDE.get(model, DEFAULT_MAX_SIDE)
+    key = f"{hashlib.sha256(data).hexdigest()}-{max_side}"
+
+    with _lock:
+        if key in _urls:
+            return _urls[key]
+
+    with metrics.span("gcs", "input_image_url"):
+        blob = _get_bucket().blob(f"{INPUT_PREFIX}/{key}.jpg")
+        # Another process (or an earlier run) may already have uploaded this image
+        if not blob.exists():
+            blob.upload_from_string(downscale(data, max_side), content_type="image/jpeg")
+
+    url = f"https://storage.googleapis.com/{BUCKET_NAME}/{blob.name}"
+    with _lock:
+        _urls[key] = url
+    return url
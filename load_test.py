@@ -0,0 +1,360 @@
+"""Multi-session load test for Snow-Blog.
+
+Runs N simulated users at once against the stand-ins in fakes.py. Each user is
+an AppTest session in its own process, since AppTest drives Streamlit's single
+process-wide Runtime and can't run on several threads at once. Every user logs
+in, browses the feed, chats, writes a post and optionally queues images, in a
+loop, until the duration is up. Reports throughput, latency percentiles per
+step, peak DB connections in use across all sessions and thread usage.
+
+Each session process has its own connection pool and password pool, where a
+real server shares one of each; the DB figures count connections in use across
+every process, i.e. what one shared pool would have needed.
+
+    python load_test.py --sessions 20 --duration 60 --llm-latency 0.8
+    python load_test.py --sessions 50 --pool-size 5 --max-overflow 0 --max-p95-ms 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from streamlit.testing.v1 import AppTest
+
+import fakes
+import image_worker
+from benchmark import APP_PATH, find
+
+STEPS = ["startup", "login", "browse_feed", "chatbot_page", "chat_new_conversation", "chat_send", "post_submit", "image_generate"]
+# Seconds allowed for a session process to import the app and get ready
+STARTUP_TIMEOUT = 120
+
+
+class PoolMonitor:
+    """Tracks connections checked out of any SQLAlchemy pool, in this and every other session process."""
+
+    def __init__(self, in_use, peak):
+        # multiprocessing.Values shared by all session processes
+        self.in_use = in_use
+        self.peak = peak
+        self.checkouts = 0
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.in_use.get_lock():
+            self.in_use.value += 1
+            self.peak.value = max(self.peak.value, self.in_use.value)
+            self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.in_use.get_lock():
+            self.in_use.value -= 1
+
+    def __enter__(self):
+        event.listen(Pool, "checkout", self.on_checkout)
+        event.listen(Pool, "checkin", self.on_checkin)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Pool, "checkout", self.on_checkout)
+        event.remove(Pool, "checkin", self.on_checkin)
+
+
+class ThreadMonitor:
+    """Samples the number of live threads in the background."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="load-test-thread-monitor", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.flows = 0
+        # Flows cut short by any exception, including navigation outside step()
+        self.failed_flows = 0
+        self.pool_checkouts = 0
+        self.peak_threads = 0
+
+    def step(self, name, action):
+        start = time.perf_counter()
+        try:
+            at = action()
+            if len(at.exception):
+                raise RuntimeError(at.exception[0].message)
+            if len(at.error):
+                raise RuntimeError(at.error[0].value)
+        except Exception as e:
+            self.errors[name] += 1
+            raise RuntimeError(f"{name}: {e}") from e
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+        return at
+
+    def state(self):
+        """Everything recorded, as plain data to send back from a session process."""
+        return {
+            "latencies": dict(self.latencies),
+            "errors": dict(self.errors),
+            "flows": self.flows,
+            "failed_flows": self.failed_flows,
+            "pool_checkouts": self.pool_checkouts,
+            "peak_threads": self.peak_threads,
+        }
+
+    def merge(self, state):
+        for name, timings in state["latencies"].items():
+            self.latencies[name].extend(timings)
+        for name, count in state["errors"].items():
+            self.errors[name] += count
+        self.flows += state["flows"]
+        self.failed_flows += state["failed_flows"]
+        self.pool_checkouts += state["pool_checkouts"]
+        self.peak_threads = max(self.peak_threads, state["peak_threads"])
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def simulated_user(index, recorder, deadline, args):
+    """Loop one user's login / browse / chat / post flow until the deadline."""
+    username = f"load_user_{index}"
+    while time.monotonic() < deadline:
+        at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+
+        def navigate(page):
+            at.sidebar.radio[0].set_value(page)
+            return at.run()
+
+        try:
+            recorder.step("startup", at.run)
+            at.sidebar.radio[0].set_value("Login").run()
+            find(at.text_input, "Username").input(username)
+            find(at.text_input, "Password").input(args.password)
+            recorder.step("login", lambda: find(at.button, "Login").click().run())
+            time.sleep(args.think_time)
+
+            for _ in range(args.feed_reruns):
+                recorder.step("browse_feed", lambda: navigate("Home"))
+                time.sleep(args.think_time)
+
+            recorder.step("chatbot_page", lambda: navigate("Chatbot"))
+            find(at.text_input, "Enter a title for the new conversation").input(f"Load {index} {time.time_ns()}")
+            recorder.step("chat_new_conversation", lambda: find(at.button, "Create New Conversation").click().run())
+            for i in range(args.chat_messages):
+                at.text_input(key="chat_input_").input(f"Message {i} from {username}")
+                recorder.step("chat_send", lambda: find(at.button, "Send").click().run())
+                time.sleep(args.think_time)
+
+            navigate("Create Post")
+            find(at.text_input, "Post Title").input(f"Post by {username}")
+            find(at.text_area, "Post Content").input("Written by load_test.py")
+            recorder.step("post_submit", lambda: find(at.button, "Submit Post").click().run())
+
+            if args.images_per_flow:
+                navigate("Image Generation")
+                for i in range(args.images_per_flow):
+                    find(at.text_area, "Enter your image prompt").input(f"Image {i} for {username}")
+                    recorder.step("image_generate", lambda: find(at.button, "Generate Image").click().run())
+        except Exception as e:
+            print(f"Session {index} failed: {e}")
+            recorder.failed_flows += 1
+            continue
+
+        recorder.flows += 1
+
+
+def session_process(index, database_url, args, start_barrier, in_use, peak, results):
+    """Run one simulated user in this process and send what it recorded back to the parent."""
+    recorder = Recorder()
+    try:
+        fakes.latencies.update(llm=args.llm_latency, fal=args.fal_latency)
+        with fakes.installed(database_url), PoolMonitor(in_use, peak) as pool, ThreadMonitor() as threads:
+            # Start the clock together once every process has imported Streamlit
+            start_barrier.wait(STARTUP_TIMEOUT)
+            simulated_user(index, recorder, time.monotonic() + args.duration, args)
+        recorder.pool_checkouts = pool.checkouts
+        recorder.peak_threads = threads.peak
+    except Exception as e:
+        print(f"Session {index} failed: {e}")
+        recorder.failed_flows += 1
+        # Don't leave the others waiting for a process that will never arrive
+        start_barrier.abort()
+    results.put(recorder.state())
+
+
+def report(recorder, pool_peak, elapsed, args):
+    pool_capacity = args.pool_size + args.max_overflow
+    result = {
+        "sessions": args.sessions,
+        "elapsed_seconds": elapsed,
+        "flows_completed": recorder.flows,
+        "flows_failed": recorder.failed_flows,
+        "flows_per_second": recorder.flows / elapsed,
+        "steps_per_second": sum(len(v) for v in recorder.latencies.values()) / elapsed,
+        "pool_capacity": pool_capacity,
+        "pool_peak_checked_out": pool_peak,
+        "pool_saturation": pool_peak / pool_capacity if pool_capacity else None,
+        "pool_checkouts": recorder.pool_checkouts,
+        "peak_threads_per_session": recorder.peak_threads,
+        "steps": {},
+    }
+    for step in STEPS:
+        timings = [t * 1000 for t in recorder.latencies.get(step, [])]
+        if not timings:
+            continue
+        result["steps"][step] = {
+            "count": len(timings),
+            "errors": recorder.errors.get(step, 0),
+            "p50_ms": percentile(timings, 50),
+            "p95_ms": percentile(timings, 95),
+            "p99_ms": percentile(timings, 99),
+            "max_ms": max(timings),
+        }
+    return result
+
+
+def print_report(result):
+    print(f"{result['sessions']} sessions for {result['elapsed_seconds']:.1f}s: "
+          f"{result['flows_completed']} flows ({result['flows_per_second']:.2f}/s), "
+          f"{result['flows_failed']} failed, "
+          f"{result['steps_per_second']:.2f} steps/s")
+    saturation = result["pool_saturation"]
+    print(f"DB pool: peak {result['pool_peak_checked_out']}/{result['pool_capacity']} connections in use across sessions"
+          + (f" ({saturation:.0%} of one shared pool)" if saturation is not None else "")
+          + f", {result['pool_checkouts']} checkouts")
+    print(f"Threads: peak {result['peak_threads_per_session']} per session process")
+    print()
+    header = f"{'step':<24}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for step, row in result["steps"].items():
+        print(f"{step:<24}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10.1f}"
+              f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session load test for Snow-Blog")
+    parser.add_argument("--sessions", type=int, default=10, help="number of concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep starting new flows")
+    parser.add_argument("--database-url", help="SQLAlchemy URL of a scratch Postgres database (default: temporary SQLite file)")
+    parser.add_argument("--pool-size", type=int, default=5, help="DB_POOL_SIZE for the app")
+    parser.add_argument("--max-overflow", type=int, default=10, help="DB_MAX_OVERFLOW for the app")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per fake OpenAI call")
+    parser.add_argument("--fal-latency", type=float, default=2.0, help="seconds per fake fal job")
+    parser.add_argument("--think-time", type=float, default=0.2, help="seconds a user pauses between actions")
+    parser.add_argument("--feed-reruns", type=int, default=3, help="Home reruns per flow")
+    parser.add_argument("--chat-messages", type=int, default=2, help="chat messages sent per flow")
+    parser.add_argument("--images-per-flow", type=int, default=0, help="images generated per flow")
+    parser.add_argument("--worker-concurrency", type=int, default=2, help="image worker threads run alongside the sessions")
+    parser.add_argument("--password", default="load_password")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds allowed per script run")
+    parser.add_argument("--max-p95-ms", type=float, help="exit non-zero if any step's p95 exceeds this")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args()
+
+    fakes.latencies.update(llm=args.llm_latency, fal=args.fal_latency)
+    database_url = args.database_url or fakes.sqlite_url()
+    os.environ["DB_POOL_SIZE"] = str(args.pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(args.max_overflow)
+
+    context = multiprocessing.get_context("spawn")
+    start_barrier = context.Barrier(args.sessions + 1)
+    in_use = context.Value("i", 0)
+    peak = context.Value("i", 0)
+    results = context.Queue()
+    processes = [
+        context.Process(target=session_process, name=f"load-user-{i}",
+                        args=(i, database_url, args, start_barrier, in_use, peak, results))
+        for i in range(args.sessions)
+    ]
+
+    with fakes.installed(database_url):
+        fakes.prepare_database(database_url)
+        # Started before this process runs AppTest, which leaves app.py as __main__ for spawn to re-import;
+        # they import Streamlit meanwhile and wait at the barrier until users are seeded
+        for process in processes:
+            process.start()
+
+        # Run the app once so create_tables() has run before users are seeded
+        AppTest.from_file(APP_PATH, default_timeout=args.timeout).run()
+        for i in range(args.sessions):
+            fakes.seed_user(database_url, f"load_user_{i}", args.password)
+
+        # Image jobs are run by worker threads standing in for image_worker.py
+        stop_worker = threading.Event()
+        worker = threading.Thread(target=image_worker.run, args=(args.worker_concurrency, 0.2, stop_worker),
+                                  name="load-test-image-worker", daemon=True)
+        if args.images_per_flow:
+            worker.start()
+
+        recorder = Recorder()
+        try:
+            start_barrier.wait(STARTUP_TIMEOUT)
+        except threading.BrokenBarrierError:
+            print("Not every session process started; timing from now")
+        start = time.monotonic()
+        # Drain results before joining, so no process blocks on a full queue
+        reported = 0
+        while reported < args.sessions:
+            try:
+                recorder.merge(results.get(timeout=args.duration + args.timeout * 10))
+                reported += 1
+            except queue.Empty:
+                break
+        elapsed = time.monotonic() - start
+        for process in processes:
+            process.join(args.timeout)
+            if process.exitcode != 0:
+                print(f"{process.name} exited with code {process.exitcode}")
+                process.kill()
+        # A session process that died without reporting counts as a failed flow
+        recorder.failed_flows += args.sessions - reported
+
+        stop_worker.set()
+        if worker.is_alive():
+            worker.join()
+
+    result = report(recorder, peak.value, elapsed, args)
+    print_report(result)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failed = result["flows_failed"] + sum(row["errors"] for row in result["steps"].values())
+    if args.max_p95_ms is not None:
+        slow = [step for step, row in result["steps"].items() if row["p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"\np95 over {args.max_p95_ms} ms: {', '.join(slow)}")
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
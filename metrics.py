@@ -0,0 +1,193 @@
+"""Process-wide timing spans and counters for database, LLM, GCS and fal calls.
+
+Streamlit reruns the app script on every interaction but imports this module only
+once, so everything recorded here accumulates for the lifetime of the server.
+Metrics are exposed in Prometheus text format via render(), an optional HTTP
+endpoint (serve) and an optional file dump (dump, or dump_every in the background).
+"""
+import contextlib
+import functools
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_latencies = {}  # (call, operation) -> {"buckets": [...], "sum": float, "count": int, "max": float}
+_errors = Counter()  # (call, operation) -> count
+_tokens = Counter()  # (model, kind) -> count
+_server = None
+_dumper = None
+
+
+def observe(call, operation, seconds):
+    with _lock:
+        entry = _latencies.get((call, operation))
+        if entry is None:
+            entry = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0, "max": 0.0}
+            _latencies[(call, operation)] = entry
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry["buckets"][i] += 1
+                break
+        entry["sum"] += seconds
+        entry["count"] += 1
+        entry["max"] = max(entry["max"], seconds)
+
+
+def record_error(call, operation):
+    with _lock:
+        _errors[(call, operation)] += 1
+
+
+def record_tokens(model, usage):
+    """Count prompt/completion tokens from an OpenAI `usage` object."""
+    if usage is None:
+        return
+    with _lock:
+        _tokens[(model, "prompt")] += getattr(usage, "prompt_tokens", 0) or 0
+        _tokens[(model, "completion")] += getattr(usage, "completion_tokens", 0) or 0
+
+
+@contextlib.contextmanager
+def span(call, operation):
+    """Time the enclosed block; exceptions are counted as errors and re-raised."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record_error(call, operation)
+        raise
+    finally:
+        observe(call, operation, time.perf_counter() - start)
+
+
+def timed(call):
+    """Decorator form of span(), using the function name as the operation."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(call, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render():
+    """Return all metrics in Prometheus text exposition format."""
+    with _lock:
+        latencies = {key: dict(entry, buckets=list(entry["buckets"])) for key, entry in _latencies.items()}
+        errors = dict(_errors)
+        tokens = dict(_tokens)
+
+    lines = [
+        "# HELP snowblog_call_duration_seconds Latency of database, LLM, GCS and fal calls.",
+        "# TYPE snowblog_call_duration_seconds histogram",
+    ]
+    for (call, operation), entry in sorted(latencies.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, entry["buckets"]):
+            cumulative += count
+            lines.append(f"snowblog_call_duration_seconds_bucket{_labels(call=call, operation=operation, le=bound)} {cumulative}")
+        lines.append(f"snowblog_call_duration_seconds_bucket{_labels(call=call, operation=operation, le='+Inf')} {entry['count']}")
+        lines.append(f"snowblog_call_duration_seconds_sum{_labels(call=call, operation=operation)} {entry['sum']}")
+        lines.append(f"snowblog_call_duration_seconds_count{_labels(call=call, operation=operation)} {entry['count']}")
+
+    lines.append("# HELP snowblog_call_errors_total Calls that raised an exception.")
+    lines.append("# TYPE snowblog_call_errors_total counter")
+    for (call, operation), count in sorted(errors.items()):
+        lines.append(f"snowblog_call_errors_total{_labels(call=call, operation=operation)} {count}")
+
+    lines.append("# HELP snowblog_llm_tokens_total OpenAI tokens used, by model and kind.")
+    lines.append("# TYPE snowblog_llm_tokens_total counter")
+    for (model, kind), count in sorted(tokens.items()):
+        lines.append(f"snowblog_llm_tokens_total{_labels(model=model, kind=kind)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """One row per (call, operation), for the diagnostics panel."""
+    with _lock:
+        rows = []
+        for (call, operation), entry in sorted(_latencies.items()):
+            rows.append({
+                "call": call,
+                "operation": operation,
+                "count": entry["count"],
+                "errors": _errors.get((call, operation), 0),
+                "mean_ms": round(entry["sum"] / entry["count"] * 1000, 1),
+                "max_ms": round(entry["max"] * 1000, 1),
+            })
+        return rows
+
+
+def token_usage():
+    with _lock:
+        return [{"model": model, "kind": kind, "tokens": count} for (model, kind), count in sorted(_tokens.items())]
+
+
+def dump(path):
+    """Write render() to `path`, replacing it atomically."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def dump_every(path, interval):
+    """Dump to `path` every `interval` seconds from a daemon thread. Safe to call more than once."""
+    global _dumper
+
+    def loop():
+        while True:
+            try:
+                dump(path)
+            except OSError as e:
+                print(f"Could not write metrics to {path}: {e}")  # Debug print
+            time.sleep(interval)
+
+    with _lock:
+        if _dumper is None:
+            _dumper = threading.Thread(target=loop, name="metrics-file", daemon=True)
+            _dumper.start()
+    return _dumper
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=None):
+    """Serve /metrics on `port` from a daemon thread. Safe to call more than once.
+
+    The endpoint has no authentication, so it listens on localhost unless `host`
+    or METRICS_HOST says otherwise (e.g. 0.0.0.0 behind a firewall).
+    """
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    global _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-endpoint", daemon=True).start()
+    return _server
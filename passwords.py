@@ -0,0 +1,196 @@
+"""Password hashing on a bounded process pool.
+
+bcrypt is deliberately slow, so hashing in the Streamlit script thread lets a
+burst of logins pin the CPU and stall every other session's reruns. Hashes run
+in a small process pool instead. The work factor is calibrated once per process
+to a target latency, and logins rehash passwords stored at a lower cost. A
+per-username limiter keeps one account from flooding the pool.
+"""
+import math
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+import types
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+# Never below the cost plain bcrypt.gensalt() used before calibration
+MIN_ROUNDS = 12
+MAX_ROUNDS = 15
+# Target time for one hash; BCRYPT_ROUNDS skips calibration altogether
+TARGET_SECONDS = float(os.getenv("BCRYPT_TARGET_SECONDS", "0.25"))
+POOL_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Hashes allowed to wait for a worker before new ones are turned away
+POOL_QUEUE = int(os.getenv("PASSWORD_QUEUE", str(POOL_WORKERS * 4)))
+QUEUE_TIMEOUT = 10
+ATTEMPTS_PER_MINUTE = int(os.getenv("LOGIN_ATTEMPTS_PER_MINUTE", "5"))
+
+
+class TooManyAttempts(Exception):
+    pass
+
+
+class PasswordServiceBusy(Exception):
+    pass
+
+
+_pool = None
+_rounds = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(POOL_WORKERS + POOL_QUEUE)
+
+_attempts = defaultdict(deque)  # username -> monotonic times of recent attempts
+_in_flight = set()
+_attempts_lock = threading.Lock()
+
+
+# These run in the worker processes
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def _time_hash(rounds):
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+    return time.perf_counter() - start
+
+
+def _ready():
+    return True
+
+
+def _start_pool():
+    """Create a pool and start all of its workers at once.
+
+    spawn re-imports __main__ in each new worker, and under Streamlit that is
+    app.py, which would connect clients and rerun its module-level code there.
+    So every worker is started here, up front, while __main__ is a blank module;
+    later submits find a worker already running and never start another. This
+    runs on first use and after a worker dies, never per hash.
+    """
+    pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    main = sys.modules["__main__"]
+    blank = types.ModuleType("__main__")
+    sys.modules["__main__"] = blank
+    try:
+        # While no worker is idle, each submit starts a new one
+        for _ in range(POOL_WORKERS):
+            pool.submit(_ready)
+    finally:
+        # Leave alone a script module installed by a Streamlit rerun that started meanwhile
+        if sys.modules["__main__"] is blank:
+            sys.modules["__main__"] = main
+    return pool
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = _start_pool()
+        return _pool
+
+
+def _replace_pool(broken):
+    global _pool
+    with _lock:
+        if _pool is broken:
+            _pool = _start_pool()
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _shutdown():
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+
+
+# multiprocessing joins a process's children before it exits; stop the workers first, ahead of
+# the pool's own queue finalizers (priority 10), or a load_test.py session process waits forever
+multiprocessing.util.Finalize(None, _shutdown, exitpriority=100)
+
+
+def _run(func, *args):
+    if not _slots.acquire(timeout=QUEUE_TIMEOUT):
+        raise PasswordServiceBusy("Too many logins in progress, please try again in a moment.")
+    try:
+        # A worker that dies (OOM killer, SIGKILL) breaks the whole pool; start a new one and retry once
+        for _ in range(2):
+            pool = _get_pool()
+            try:
+                return pool.submit(func, *args).result()
+            except BrokenProcessPool as e:
+                print(f"Password pool broken, restarting it: {e}")  # Debug print
+                _replace_pool(pool)
+        raise PasswordServiceBusy("The password service is restarting, please try again in a moment.")
+    finally:
+        _slots.release()
+
+
+def get_rounds():
+    """The bcrypt cost for new hashes, calibrated on first use."""
+    global _rounds
+    with _lock:
+        if _rounds is not None:
+            return _rounds
+    if os.getenv("BCRYPT_ROUNDS"):
+        rounds = int(os.getenv("BCRYPT_ROUNDS"))
+    else:
+        # Each extra round doubles the cost
+        elapsed = min(_run(_time_hash, MIN_ROUNDS) for _ in range(2))
+        rounds = MIN_ROUNDS + int(math.log2(TARGET_SECONDS / elapsed)) if elapsed < TARGET_SECONDS else MIN_ROUNDS
+        rounds = max(MIN_ROUNDS, min(MAX_ROUNDS, rounds))
+        print(f"bcrypt calibrated to {rounds} rounds ({elapsed * 1000:.0f} ms at {MIN_ROUNDS})")  # Debug print
+    with _lock:
+        _rounds = rounds
+    return rounds
+
+
+def hash_password(password):
+    return _run(_hashpw, password.encode('utf-8'), get_rounds()).decode('utf-8')
+
+
+def verify_password(password, hashed):
+    return _run(_checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed):
+    # Hashes look like $2b$12$..., where 12 is the cost
+    try:
+        return int(hashed.split("$")[2]) < get_rounds()
+    except (IndexError, ValueError):
+        return False
+
+
+def start_attempt(username):
+    """Register a login attempt, or raise TooManyAttempts. Pair with finish_attempt()."""
+    now = time.monotonic()
+    with _attempts_lock:
+        # Forget usernames that have gone quiet, so random usernames can't grow this forever
+        if len(_attempts) > 10000:
+            for name in [name for name, times in _attempts.items() if not times or now - times[-1] > 60]:
+                del _attempts[name]
+        attempts = _attempts[username]
+        while attempts and now - attempts[0] > 60:
+            attempts.popleft()
+        if username in _in_flight or len(attempts) >= ATTEMPTS_PER_MINUTE:
+            raise TooManyAttempts("Too many login attempts, please wait a minute and try again.")
+        attempts.append(now)
+        _in_flight.add(username)
+
+
+def finish_attempt(username, success):
+    with _attempts_lock:
+        _in_flight.discard(username)
+        if success:
+            _attempts.pop(username, None)